@@ -0,0 +1,40 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+# Optional native autocorrelation kernels for app.audio.
+# Build with `python tunefind_cli.py build-dsp`; app.audio falls back to
+# Numba/NumPy when this module is not compiled.
+import numpy as np
+
+
+cpdef autocorr_sweep(const float[::1] x, int lag_min, int lag_max):
+    cdef Py_ssize_t n = x.shape[0]
+    cdef Py_ssize_t lag, i
+    cdef double corr
+    out = np.zeros(lag_max - lag_min + 1, dtype=np.float64)
+    cdef double[::1] out_view = out
+    for lag in range(lag_min, lag_max + 1):
+        corr = 0.0
+        for i in range(lag, n):
+            corr += x[i] * x[i - lag]
+        out_view[lag - lag_min] = corr
+    return out
+
+
+cpdef pitch_lags(const float[:, :] frames, int min_lag, int max_lag):
+    cdef Py_ssize_t n_frames = frames.shape[0]
+    cdef Py_ssize_t n = frames.shape[1]
+    cdef Py_ssize_t f, lag, i, best_lag
+    cdef double corr, best_corr
+    out = np.empty(n_frames, dtype=np.int64)
+    cdef long long[::1] out_view = out
+    for f in range(n_frames):
+        best_lag = min_lag
+        best_corr = -1e300
+        for lag in range(min_lag, max_lag + 1):
+            corr = 0.0
+            for i in range(n - lag):
+                corr += frames[f, i] * frames[f, i + lag]
+            if corr > best_corr:
+                best_corr = corr
+                best_lag = lag
+        out_view[f] = best_lag
+    return out
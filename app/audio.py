@@ -1,29 +1,78 @@
 from __future__ import annotations
 
+import functools
+import hashlib
 import io
 import math
 import os
 import shutil
 import subprocess
 import tempfile
+import threading
 import wave
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable
 from dataclasses import dataclass
 
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # optional: JIT-compiled kernels, NumPy is used otherwise
+    numba = None
+
+try:
+    from app import _dsp
+except ImportError:  # optional: Cython kernels, see scripts/build_dsp_extension.py
+    _dsp = None
+
 TARGET_SR = 8000
 FRAME_SIZE = 400
 HOP_SIZE = 160
+ANALYSIS_CACHE_SIZE = 256
+# Autocorrelation lags used as hum-friendly periodicity clues.
+AC_LAGS = (20, 40, 80, 120)
+
+KEY_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+
+# Krumhansl-Schmuckler key profiles; row i is the profile rotated to tonic i.
+# The *_NORM variants are z-scored so a matmul against a z-scored chroma
+# vector (divided by 12) gives the Pearson correlation per tonic.
+_MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+_MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+_MAJOR_ROT = np.stack([np.roll(_MAJOR_PROFILE, i) for i in range(12)]).astype(np.float32)
+_MINOR_ROT = np.stack([np.roll(_MINOR_PROFILE, i) for i in range(12)]).astype(np.float32)
+_MAJOR_NORM = ((_MAJOR_ROT - _MAJOR_PROFILE.mean()) / _MAJOR_PROFILE.std()).astype(np.float32)
+_MINOR_NORM = ((_MINOR_ROT - _MINOR_PROFILE.mean()) / _MINOR_PROFILE.std()).astype(np.float32)
 
 
 @dataclass(frozen=True)
 class AudioFeatures:
-    vector: list[float]
+    vector: np.ndarray
     duration_s: float
     sample_rate: int
 
 
-def _read_wav_mono(file_bytes: bytes) -> tuple[list[float], int]:
-    with wave.open(io.BytesIO(file_bytes), "rb") as wav:
+# sha256(upload) -> analyze_audio result, least recently used first.
+_analysis_cache: OrderedDict[bytes, tuple[AudioFeatures, int | None, str | None]] = OrderedDict()
+_analysis_lock = threading.Lock()
+
+# Threads used to score wavelet BPM windows, shared by all calls. Pool worker
+# processes set this to 1 so N processes don't each start N threads.
+_bpm_threads = os.cpu_count() or 1
+_bpm_pool: ThreadPoolExecutor | None = None
+_bpm_pool_lock = threading.Lock()
+
+
+def _open_source(source: bytes | Path) -> io.BytesIO | str:
+    # Decoders take either in-memory bytes or a path to a spooled upload.
+    return io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else str(source)
+
+
+def _read_wav_mono(source: bytes | Path) -> tuple[np.ndarray, int]:
+    with wave.open(_open_source(source), "rb") as wav:
         channels = wav.getnchannels()
         sample_width = wav.getsampwidth()
         sample_rate = wav.getframerate()
@@ -33,20 +82,17 @@ def _read_wav_mono(file_bytes: bytes) -> tuple[list[float], int]:
     if sample_width != 2:
         raise ValueError("Only 16-bit PCM WAV files are supported.")
 
-    total_samples = len(raw) // 2
-    ints = [int.from_bytes(raw[i * 2 : i * 2 + 2], "little", signed=True) for i in range(total_samples)]
-
+    ints = np.frombuffer(raw, dtype="<i2")
     if channels > 1:
-        mono = []
-        for i in range(0, len(ints), channels):
-            mono.append(sum(ints[i : i + channels]) / channels)
-        ints = mono
+        samples = ints.reshape(-1, channels).astype(np.float32).mean(axis=1)
+    else:
+        samples = ints.astype(np.float32)
 
-    floats = [s / 32768.0 for s in ints]
-    return floats, sample_rate
+    samples *= 1.0 / 32768.0
+    return samples, sample_rate
 
 
-def _read_pydub_mono(file_bytes: bytes) -> tuple[list[float], int]:
+def _read_pydub_mono(source: bytes | Path) -> tuple[np.ndarray, int]:
     try:
         from pydub import AudioSegment
     except ImportError as exc:
@@ -62,138 +108,205 @@ def _read_pydub_mono(file_bytes: bytes) -> tuple[list[float], int]:
     errors = []
     for fmt in ("webm", "ogg", "mp3", "m4a", "mp4", "aac", "flac"):
         try:
-            segment = AudioSegment.from_file(io.BytesIO(file_bytes), format=fmt)
+            segment = AudioSegment.from_file(_open_source(source), format=fmt)
             break
         except Exception as exc:
             errors.append(exc)
     if segment is None:
         raise ValueError("Failed to decode audio. Supported formats require ffmpeg.") from errors[-1]
 
-    samples = list(segment.get_array_of_samples())
+    samples = np.asarray(segment.get_array_of_samples())
     channels = segment.channels
     sample_rate = segment.frame_rate
     sample_width = segment.sample_width
 
     if channels > 1:
-        mono = []
-        for i in range(0, len(samples), channels):
-            mono.append(sum(samples[i : i + channels]) / channels)
-        samples = mono
+        samples = samples.reshape(-1, channels).astype(np.float32).mean(axis=1)
+    else:
+        samples = samples.astype(np.float32)
 
     max_amp = float(1 << (8 * sample_width - 1)) or 1.0
-    floats = [s / max_amp for s in samples]
-    return floats, sample_rate
+    samples *= 1.0 / max_amp
+    return samples, sample_rate
 
 
-def _read_audio_mono(file_bytes: bytes) -> tuple[list[float], int]:
+def _read_audio_mono(source: bytes | Path) -> tuple[np.ndarray, int]:
     try:
-        return _read_wav_mono(file_bytes)
+        return _read_wav_mono(source)
     except (wave.Error, EOFError):
-        return _read_pydub_mono(file_bytes)
+        return _read_pydub_mono(source)
 
 
-def _resample_linear(samples: list[float], src_sr: int, dst_sr: int) -> list[float]:
+def _resample_linear(samples: np.ndarray, src_sr: int, dst_sr: int) -> np.ndarray:
     if src_sr == dst_sr:
         return samples
-    if not samples:
+    if len(samples) == 0:
         return samples
 
     out_len = max(1, int(len(samples) * dst_sr / src_sr))
-    out = []
-    for i in range(out_len):
-        x = i * (len(samples) - 1) / max(1, out_len - 1)
-        left = int(math.floor(x))
-        right = min(left + 1, len(samples) - 1)
-        frac = x - left
-        out.append(samples[left] * (1 - frac) + samples[right] * frac)
-    return out
+    x = np.linspace(0, len(samples) - 1, out_len)
+    return np.interp(x, np.arange(len(samples)), samples).astype(np.float32, copy=False)
 
 
-def _frame_iter(samples: list[float]) -> list[list[float]]:
+def _resample(samples: np.ndarray, src_sr: int, dst_sr: int) -> np.ndarray:
+    if src_sr == dst_sr or len(samples) == 0:
+        return samples
+    try:
+        from scipy.signal import resample_poly
+    except ImportError:
+        return _resample_linear(samples, src_sr, dst_sr)
+
+    # Polyphase FIR resampling: anti-aliased, and one C call for the
+    # typical 44.1k/48k -> 8k ratios.
+    g = math.gcd(src_sr, dst_sr)
+    return resample_poly(samples, dst_sr // g, src_sr // g).astype(np.float32, copy=False)
+
+
+def _frame_iter(samples: np.ndarray) -> np.ndarray:
     if len(samples) < FRAME_SIZE:
-        samples = samples + [0.0] * (FRAME_SIZE - len(samples))
-    frames = []
-    for start in range(0, len(samples) - FRAME_SIZE + 1, HOP_SIZE):
-        frames.append(samples[start : start + FRAME_SIZE])
-    return frames
-
-
-def _frame_features(frame: list[float]) -> list[float]:
-    energy = sum(x * x for x in frame) / len(frame)
-
-    zc = 0
-    for a, b in zip(frame[:-1], frame[1:]):
-        if (a >= 0 and b < 0) or (a < 0 and b >= 0):
-            zc += 1
-    zcr = zc / max(1, len(frame) - 1)
-
-    # Simple autocorrelation-based periodicity clues (hum-friendly).
-    lags = [20, 40, 80, 120]
-    ac = []
-    for lag in lags:
-        if lag >= len(frame):
-            ac.append(0.0)
-            continue
-        corr = 0.0
-        for i in range(len(frame) - lag):
-            corr += frame[i] * frame[i + lag]
-        ac.append(corr / (len(frame) - lag))
-
-    return [energy, zcr, *ac]
-
-
-def _prepare_samples(file_bytes: bytes) -> list[float]:
-    samples, sr = _read_audio_mono(file_bytes)
-    if not samples:
+        samples = np.pad(samples, (0, FRAME_SIZE - len(samples)))
+    # Zero-copy (n_frames, FRAME_SIZE) view over the samples.
+    return np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE]
+
+
+if numba is not None:
+    # Serial kernels: request threads call these concurrently, which numba's
+    # fallback "workqueue" threading layer can't take with parallel=True, and
+    # the analysis worker processes already use every core.
+
+    @numba.njit(cache=True, fastmath=True)
+    def _frame_features_nb(frames: np.ndarray, lags: np.ndarray) -> np.ndarray:
+        n_frames, n = frames.shape
+        out = np.empty((n_frames, 2 + len(lags)))
+        for f in range(n_frames):
+            energy = 0.0
+            zc = 0
+            for i in range(n):
+                energy += frames[f, i] * frames[f, i]
+                if i and (frames[f, i - 1] < 0) != (frames[f, i] < 0):
+                    zc += 1
+            out[f, 0] = energy / n
+            out[f, 1] = zc / (n - 1)
+            for j in range(len(lags)):
+                lag = lags[j]
+                corr = 0.0
+                for i in range(n - lag):
+                    corr += frames[f, i] * frames[f, i + lag]
+                out[f, 2 + j] = corr / (n - lag)
+        return out
+
+    @numba.njit(cache=True, fastmath=True)
+    def _autocorr_sweep_nb(x: np.ndarray, lag_min: int, lag_max: int) -> np.ndarray:
+        out = np.zeros(lag_max - lag_min + 1)
+        for j in range(lag_max - lag_min + 1):
+            lag = lag_min + j
+            corr = 0.0
+            for i in range(lag, len(x)):
+                corr += x[i] * x[i - lag]
+            out[j] = corr
+        return out
+
+    @numba.njit(cache=True, fastmath=True)
+    def _pitch_ac_nb(frames: np.ndarray, min_lag: int, max_lag: int) -> np.ndarray:
+        n_frames, n = frames.shape
+        best_lags = np.empty(n_frames, dtype=np.int64)
+        for f in range(n_frames):
+            best_lag = min_lag
+            best_corr = -np.inf
+            for lag in range(min_lag, max_lag + 1):
+                corr = 0.0
+                for i in range(n - lag):
+                    corr += frames[f, i] * frames[f, i + lag]
+                if corr > best_corr:
+                    best_corr = corr
+                    best_lag = lag
+            best_lags[f] = best_lag
+        return best_lags
+
+
+# Energy, zero-crossing rate and AC_LAGS autocorrelations, one row per frame.
+def _frame_features(frames: np.ndarray) -> np.ndarray:
+    if numba is not None:
+        return _frame_features_nb(frames, np.asarray(AC_LAGS, dtype=np.int64))
+    energy = (frames * frames).mean(axis=1)
+    sign = np.signbit(frames)
+    zcr = (np.count_nonzero(sign[:, :-1] ^ sign[:, 1:], axis=1) / (frames.shape[1] - 1)).astype(np.float32)
+    ac = [(frames[:, :-lag] * frames[:, lag:]).mean(axis=1) for lag in AC_LAGS]
+    return np.column_stack([energy, zcr, *ac])
+
+
+def _autocorr_sweep(x: np.ndarray, lag_min: int, lag_max: int) -> np.ndarray:
+    if _dsp is not None:
+        return _dsp.autocorr_sweep(np.ascontiguousarray(x, dtype=np.float32), lag_min, lag_max)
+    if numba is not None:
+        return _autocorr_sweep_nb(x, lag_min, lag_max)
+    # Zero padding to at least 2n keeps the circular FFT correlation from
+    # wrapping into the lags we read.
+    n = len(x)
+    n_fft = 1 << (2 * n - 1).bit_length()
+    spectrum = np.fft.rfft(x, n_fft)
+    corr = np.fft.irfft(spectrum * spectrum.conj(), n_fft)[: min(n, lag_max + 1)]
+    scores = np.zeros(lag_max + 1)
+    scores[: len(corr)] = corr
+    return scores[lag_min:]
+
+
+# Strongest autocorrelation lag in min_lag..max_lag for every frame.
+def _pitch_lags(frames: np.ndarray, min_lag: int, max_lag: int) -> np.ndarray:
+    if _dsp is not None:
+        return _dsp.pitch_lags(np.asarray(frames, dtype=np.float32), min_lag, max_lag)
+    if numba is not None:
+        return _pitch_ac_nb(frames, min_lag, max_lag)
+    ac = np.empty((len(frames), max_lag - min_lag + 1), dtype=frames.dtype)
+    for lag in range(min_lag, max_lag + 1):
+        ac[:, lag - min_lag] = np.einsum("ij,ij->i", frames[:, :-lag], frames[:, lag:])
+    return min_lag + ac.argmax(axis=1)
+
+
+def _decode_samples(source: bytes | Path) -> tuple[np.ndarray, int]:
+    samples, sr = _read_audio_mono(source)
+    if len(samples) == 0:
         raise ValueError("Audio file is empty.")
+    return samples, sr
 
-    samples = _resample_linear(samples, sr, TARGET_SR)
-    peak = max(abs(x) for x in samples) or 1.0
-    return [x / peak for x in samples]
 
+def _normalize_peak(samples: np.ndarray) -> np.ndarray:
+    # Scales to a peak of 1.0 in place; max/min avoid an abs() temporary.
+    peak = max(float(samples.max()), -float(samples.min())) or 1.0
+    samples *= 1.0 / peak
+    return samples
 
-def _prepare_samples_raw(file_bytes: bytes) -> tuple[list[float], int]:
-    samples, sr = _read_audio_mono(file_bytes)
-    if not samples:
-        raise ValueError("Audio file is empty.")
 
-    peak = max(abs(x) for x in samples) or 1.0
-    return [x / peak for x in samples], sr
+def _prepare_samples(samples: np.ndarray, sr: int) -> np.ndarray:
+    return _normalize_peak(_resample(samples, sr, TARGET_SR))
 
 
-def _compute_features(samples: list[float]) -> AudioFeatures:
+def _compute_features(samples: np.ndarray) -> AudioFeatures:
     frames = _frame_iter(samples)
-    feats = [_frame_features(f) for f in frames]
 
-    # Aggregate with mean/std per feature.
-    n_features = len(feats[0])
-    means = [sum(row[i] for row in feats) / len(feats) for i in range(n_features)]
-    stds = []
-    for i in range(n_features):
-        m = means[i]
-        var = sum((row[i] - m) ** 2 for row in feats) / len(feats)
-        stds.append(math.sqrt(var))
+    feats = _frame_features(frames)
 
-    vector = means + stds
-    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
-    vector = [v / norm for v in vector]
+    # Aggregate with mean/std per feature. The frame matrix stays float32;
+    # only this small (n_frames, 6) summary is accumulated in float64.
+    vector = np.concatenate([feats.mean(axis=0, dtype=np.float64), feats.std(axis=0, dtype=np.float64)])
+    vector /= np.linalg.norm(vector) or 1.0
 
-    return AudioFeatures(vector=vector, duration_s=len(samples) / TARGET_SR, sample_rate=TARGET_SR)
+    return AudioFeatures(vector=vector.astype(np.float32), duration_s=len(samples) / TARGET_SR, sample_rate=TARGET_SR)
 
 
-def _estimate_bpm(samples: list[float], sr: int) -> int | None:
+def _estimate_bpm(samples: np.ndarray, sr: int) -> int | None:
     if len(samples) < sr:
         return None
     frames = _frame_iter(samples)
-    energies = [sum(x * x for x in frame) for frame in frames]
+    energies = np.einsum("ij,ij->i", frames, frames)
     if len(energies) < 4:
         return None
 
-    onset = [max(0.0, energies[i] - energies[i - 1]) for i in range(1, len(energies))]
-    max_onset = max(onset) if onset else 0.0
+    onset = np.maximum(np.diff(energies), 0.0)
+    max_onset = float(onset.max())
     if max_onset <= 1e-8:
         return None
-    onset = [v / max_onset for v in onset]
+    onset /= max_onset
 
     frames_per_second = sr / HOP_SIZE
     lag_min = int(frames_per_second * 60 / 200)  # 200 BPM
@@ -201,18 +314,8 @@ def _estimate_bpm(samples: list[float], sr: int) -> int | None:
     if lag_max <= lag_min:
         return None
 
-    best_lag = None
-    best_score = -1.0
-    for lag in range(lag_min, lag_max + 1):
-        score = 0.0
-        for i in range(lag, len(onset)):
-            score += onset[i] * onset[i - lag]
-        if score > best_score:
-            best_score = score
-            best_lag = lag
-
-    if not best_lag:
-        return None
+    best_lag = lag_min + int(np.argmax(_autocorr_sweep(onset, lag_min, lag_max)))
+
     bpm = int(round(60 * frames_per_second / best_lag))
     # Normalize to a common range
     while bpm < 60:
@@ -222,175 +325,150 @@ def _estimate_bpm(samples: list[float], sr: int) -> int | None:
     return bpm
 
 
-def _estimate_bpm_wavelet(file_bytes: bytes, window_s: float = 3.0) -> int | None:
-    try:
-        import numpy as np
-        import pywt
-        from scipy import signal
-    except Exception:
+def _peak_detect(arr: np.ndarray) -> np.ndarray | None:
+    if arr.size == 0:
+        return None
+    max_val = np.amax(np.abs(arr))
+    if max_val <= 0:
+        return None
+    peak_ndx = np.where(arr == max_val)[0]
+    if peak_ndx.size == 0:
+        peak_ndx = np.where(arr == -max_val)[0]
+    return peak_ndx if peak_ndx.size else None
+
+
+def _bpm_detector(segment: np.ndarray, fs: int) -> float | None:
+    import pywt
+
+    cA = []
+    cD = []
+    levels = 4
+    max_decimation = 2 ** (levels - 1)
+    min_ndx = math.floor(60.0 / 220 * (fs / max_decimation))
+    max_ndx = math.floor(60.0 / 40 * (fs / max_decimation))
+    if max_ndx <= min_ndx:
+        return None
+
+    cD_sum = None
+    for loop in range(0, levels):
+        if loop == 0:
+            cA, cD = pywt.dwt(segment, "db4")
+            cD_minlen = int(len(cD) / max_decimation + 1)
+            cD_sum = np.zeros(cD_minlen)
+        else:
+            cA, cD = pywt.dwt(cA, "db4")
+
+        # The reference detector smooths with lfilter([0.01], [1 - 0.99], x);
+        # with a = [0.01] that is x * 0.01 / 0.01, i.e. a no-op, so skip it.
+        cD = np.abs(cD[:: (2 ** (levels - loop - 1))])
+        cD = cD - np.mean(cD)
+        cD_sum = cD[: len(cD_sum)] + cD_sum
+
+    if not np.any(cA):
+        return None
+
+    cA = np.abs(cA)
+    cA = cA - np.mean(cA)
+    cD_sum = cA[: len(cD_sum)] + cD_sum
+
+    correl = np.correlate(cD_sum, cD_sum, "full")
+    midpoint = int(len(correl) / 2)
+    correl_mid = correl[midpoint:]
+    peak_ndx = _peak_detect(correl_mid[min_ndx:max_ndx])
+    if peak_ndx is None or peak_ndx.size == 0:
         return None
+    peak_ndx_adjusted = int(peak_ndx[0]) + min_ndx
+    if peak_ndx_adjusted == 0:
+        return None
+    bpm_val = 60.0 / peak_ndx_adjusted * (fs / max_decimation)
+    return bpm_val
+
 
+def _estimate_bpm_wavelet(samples: np.ndarray, sr: int, window_s: float = 3.0) -> int | None:
     try:
-        samples, sr = _prepare_samples_raw(file_bytes)
+        import pywt  # noqa: F401
     except Exception:
         return None
 
-    if not samples or sr <= 0:
+    if len(samples) == 0 or sr <= 0:
         return None
 
-    data = np.asarray(samples, dtype=float)
+    data = np.asarray(samples, dtype=np.float32)
     window_samps = int(window_s * sr)
     if window_samps <= 0 or len(data) < window_samps:
         return None
 
-    def peak_detect(arr: np.ndarray) -> np.ndarray | None:
-        if arr.size == 0:
-            return None
-        max_val = np.amax(np.abs(arr))
-        if max_val <= 0:
-            return None
-        peak_ndx = np.where(arr == max_val)[0]
-        if peak_ndx.size == 0:
-            peak_ndx = np.where(arr == -max_val)[0]
-        return peak_ndx if peak_ndx.size else None
-
-    def bpm_detector(segment: np.ndarray, fs: int) -> float | None:
-        cA = []
-        cD = []
-        levels = 4
-        max_decimation = 2 ** (levels - 1)
-        min_ndx = math.floor(60.0 / 220 * (fs / max_decimation))
-        max_ndx = math.floor(60.0 / 40 * (fs / max_decimation))
-        if max_ndx <= min_ndx:
-            return None
-
-        cD_sum = None
-        for loop in range(0, levels):
-            if loop == 0:
-                cA, cD = pywt.dwt(segment, "db4")
-                cD_minlen = int(len(cD) / max_decimation + 1)
-                cD_sum = np.zeros(cD_minlen)
-            else:
-                cA, cD = pywt.dwt(cA, "db4")
-
-            cD = signal.lfilter([0.01], [1 - 0.99], cD)
-            cD = np.abs(cD[:: (2 ** (levels - loop - 1))])
-            cD = cD - np.mean(cD)
-            cD_sum = cD[: len(cD_sum)] + cD_sum
-
-        if not np.any(cA):
-            return None
-
-        cA = signal.lfilter([0.01], [1 - 0.99], cA)
-        cA = np.abs(cA)
-        cA = cA - np.mean(cA)
-        cD_sum = cA[: len(cD_sum)] + cD_sum
-
-        correl = np.correlate(cD_sum, cD_sum, "full")
-        midpoint = int(len(correl) / 2)
-        correl_mid = correl[midpoint:]
-        peak_ndx = peak_detect(correl_mid[min_ndx:max_ndx])
-        if peak_ndx is None or peak_ndx.size == 0:
-            return None
-        peak_ndx_adjusted = int(peak_ndx[0]) + min_ndx
-        if peak_ndx_adjusted == 0:
-            return None
-        bpm_val = 60.0 / peak_ndx_adjusted * (fs / max_decimation)
-        return bpm_val
-
+    # Windows are independent and pywt/scipy/numpy release the GIL in their
+    # C loops, so score them on a thread pool. Segments are views into data.
     max_window_ndx = int(len(data) / window_samps)
-    bpms = []
-    for w in range(max_window_ndx):
-        seg = data[w * window_samps : (w + 1) * window_samps]
-        bpm_val = bpm_detector(seg, sr)
-        if bpm_val:
-            bpms.append(bpm_val)
+    segments = [data[w * window_samps : (w + 1) * window_samps] for w in range(max_window_ndx)]
+    if _bpm_threads > 1 and max_window_ndx > 1:
+        results = list(_bpm_executor().map(_bpm_detector, segments, [sr] * len(segments)))
+    else:
+        results = [_bpm_detector(seg, sr) for seg in segments]
+    bpms = [bpm_val for bpm_val in results if bpm_val]
 
     if not bpms:
         return None
     return int(round(float(np.median(bpms))))
 
 
-def _estimate_key(samples: list[float], sr: int) -> str | None:
+def _bpm_executor() -> ThreadPoolExecutor:
+    global _bpm_pool
+    with _bpm_pool_lock:
+        if _bpm_pool is None:
+            _bpm_pool = ThreadPoolExecutor(max_workers=_bpm_threads, thread_name_prefix="bpm")
+        return _bpm_pool
+
+
+def set_analysis_threads(count: int) -> None:
+    global _bpm_threads, _bpm_pool
+    with _bpm_pool_lock:
+        _bpm_threads = max(1, count)
+        if _bpm_pool is not None:
+            _bpm_pool.shutdown(wait=False)
+            _bpm_pool = None
+
+
+def _best_key(maj_scores: np.ndarray, min_scores: np.ndarray) -> tuple[int, bool]:
+    # Interleave as maj0, min0, maj1, ... so argmax breaks ties the same way
+    # as scanning tonics in order with major before minor.
+    best = int(np.argmax(np.column_stack([maj_scores, min_scores]).ravel()))
+    return best // 2, best % 2 == 0
+
+
+def _estimate_key(samples: np.ndarray, sr: int) -> str | None:
     frames = _frame_iter(samples)
-    if not frames:
+    if len(frames) == 0:
         return None
 
-    # Krumhansl-Schmuckler key profiles
-    major = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
-    minor = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
-    pitch_classes = [0.0] * 12
-
     min_lag = max(1, int(sr / 1000))
-    max_lag = min(len(frames[0]) - 1, int(sr / 50))
+    max_lag = min(frames.shape[1] - 1, int(sr / 50))
 
     frame_step = max(1, len(frames) // 300)
-    for frame in frames[::frame_step]:
-        energy = sum(x * x for x in frame)
-        if energy <= 1e-6:
-            continue
-        best_lag = None
-        best_corr = -1.0
-        for lag in range(min_lag, max_lag + 1):
-            corr = 0.0
-            for i in range(len(frame) - lag):
-                corr += frame[i] * frame[i + lag]
-            if corr > best_corr:
-                best_corr = corr
-                best_lag = lag
-        if not best_lag:
-            continue
-        freq = sr / best_lag
-        if freq < 50 or freq > 1000:
-            continue
-        midi = 69 + 12 * math.log2(freq / 440.0)
-        pc = int(round(midi)) % 12
-        pitch_classes[pc] += energy
-
-    if max(pitch_classes) <= 0:
-        return None
+    selected = frames[::frame_step]
+    energy = np.einsum("ij,ij->i", selected, selected)
+    voiced = energy > 1e-6
+    selected = selected[voiced]
+    energy = energy[voiced]
 
-    def rotate(profile: list[float], n: int) -> list[float]:
-        return profile[-n:] + profile[:-n]
-
-    best_key = None
-    best_score = -1.0
-    is_major = True
-    for i in range(12):
-        maj_score = sum(p * c for p, c in zip(rotate(major, i), pitch_classes))
-        min_score = sum(p * c for p, c in zip(rotate(minor, i), pitch_classes))
-        if maj_score > best_score:
-            best_score = maj_score
-            best_key = i
-            is_major = True
-        if min_score > best_score:
-            best_score = min_score
-            best_key = i
-            is_major = False
-
-    if best_key is None:
-        return None
-    names = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-    return f"{names[best_key]}{'m' if not is_major else ''}"
+    best_lags = _pitch_lags(selected, min_lag, max_lag)
+
+    freq = sr / best_lags
+    in_range = (freq >= 50) & (freq <= 1000)
+    midi = 69 + 12 * np.log2(freq[in_range] / 440.0)
+    pc = np.rint(midi).astype(np.int64) % 12
+    pitch_classes = np.bincount(pc, weights=energy[in_range], minlength=12)
 
+    if pitch_classes.max() <= 0:
+        return None
 
-def _guess_ext(file_bytes: bytes) -> str:
-    header = file_bytes[:16]
-    if header.startswith(b"RIFF") and b"WAVE" in header:
-        return ".wav"
-    if header.startswith(b"ID3") or header[:2] == b"\xff\xfb":
-        return ".mp3"
-    if header.startswith(b"OggS"):
-        return ".ogg"
-    if header.startswith(b"\x1a\x45\xdf\xa3"):
-        return ".webm"
-    if len(header) >= 12 and header[4:8] == b"ftyp":
-        return ".m4a"
-    return ".audio"
+    best_key, is_major = _best_key(_MAJOR_ROT @ pitch_classes, _MINOR_ROT @ pitch_classes)
+    return f"{KEY_NAMES[best_key]}{'m' if not is_major else ''}"
 
 
-def _find_keyfinder_cli() -> str | None:
-    env_path = os.getenv("TUNEFIND_KEYFINDER_PATH")
+@functools.lru_cache(maxsize=8)
+def _locate_keyfinder_cli(env_path: str | None) -> str | None:
     if env_path and Path(env_path).exists():
         return env_path
     root = Path(__file__).resolve().parent.parent
@@ -405,6 +483,19 @@ def _find_keyfinder_cli() -> str | None:
     return shutil.which("keyfinder-cli")
 
 
+def invalidate_keyfinder_cache() -> None:
+    _locate_keyfinder_cli.cache_clear()
+
+
+def _find_keyfinder_cli() -> str | None:
+    # Lookups are memoised per TUNEFIND_KEYFINDER_PATH value; misses are not
+    # kept so an install made while the server is running is picked up.
+    path = _locate_keyfinder_cli(os.getenv("TUNEFIND_KEYFINDER_PATH"))
+    if path is None:
+        invalidate_keyfinder_cache()
+    return path
+
+
 def _require_keyfinder_cli() -> str:
     path = _find_keyfinder_cli()
     if not path:
@@ -415,12 +506,25 @@ def _require_keyfinder_cli() -> str:
     return path
 
 
-def _estimate_key_keyfinder_cli(file_bytes: bytes) -> str:
+def _samples_to_wav_bytes(samples: np.ndarray, sr: int) -> bytes:
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sr)
+        wav.writeframes(pcm.tobytes())
+    return buf.getvalue()
+
+
+def _estimate_key_keyfinder_cli(samples: np.ndarray, sr: int) -> str:
     path = _require_keyfinder_cli()
-    suffix = _guess_ext(file_bytes)
+    # keyfinder-cli gets the already-decoded audio as 16-bit PCM WAV, which it
+    # reads directly instead of running the original upload through ffmpeg.
+    wav_bytes = _samples_to_wav_bytes(samples, sr)
     try:
-        with tempfile.NamedTemporaryFile(suffix=suffix, delete=True) as tmp:
-            tmp.write(file_bytes)
+        with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as tmp:
+            tmp.write(wav_bytes)
             tmp.flush()
             result = subprocess.run(
                 [path, "-n", "standard", tmp.name],
@@ -429,6 +533,7 @@ def _estimate_key_keyfinder_cli(file_bytes: bytes) -> str:
                 timeout=20,
             )
     except Exception as exc:
+        invalidate_keyfinder_cache()
         raise RuntimeError(f"Failed to run keyfinder-cli: {exc}") from exc
     if result.returncode != 0:
         stderr = (result.stderr or "").strip()
@@ -442,7 +547,6 @@ def _estimate_key_keyfinder_cli(file_bytes: bytes) -> str:
 
 def _estimate_key_librosa(file_bytes: bytes) -> str | None:
     try:
-        import numpy as np
         import librosa
     except Exception:
         return None
@@ -451,11 +555,10 @@ def _estimate_key_librosa(file_bytes: bytes) -> str | None:
         samples, sr = _read_audio_mono(file_bytes)
     except Exception:
         return None
-    if not samples:
+    if len(samples) == 0:
         return None
 
-    peak = max(abs(x) for x in samples) or 1.0
-    y = np.asarray([x / peak for x in samples], dtype=np.float32)
+    y = _normalize_peak(samples)
     max_len = sr * 60
     if len(y) > max_len:
         y = y[:max_len]
@@ -469,48 +572,74 @@ def _estimate_key_librosa(file_bytes: bytes) -> str | None:
     if not np.any(chroma_vals):
         return None
 
-    pitches = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-    keyfreqs = {pitches[i]: chroma_vals[i] for i in range(12)}
-
-    maj_profile = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
-    min_profile = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
-
-    best_key = None
-    best_score = -1.0
-    is_major = True
-    for i in range(12):
-        key_test = [keyfreqs.get(pitches[(i + m) % 12]) for m in range(12)]
-        maj = np.corrcoef(maj_profile, key_test)[1, 0]
-        minor = np.corrcoef(min_profile, key_test)[1, 0]
-        if maj > best_score:
-            best_score = maj
-            best_key = i
-            is_major = True
-        if minor > best_score:
-            best_score = minor
-            best_key = i
-            is_major = False
-
-    if best_key is None or math.isnan(best_score):
+    spread = float(chroma_vals.std())
+    if spread <= 0:
         return None
-    return f"{pitches[best_key]}{'m' if not is_major else ''}"
+
+    chroma_z = (chroma_vals - chroma_vals.mean()) / spread
+    best_key, is_major = _best_key(_MAJOR_NORM @ chroma_z / 12, _MINOR_NORM @ chroma_z / 12)
+    return f"{KEY_NAMES[best_key]}{'m' if not is_major else ''}"
 
 
-def analyze_audio(file_bytes: bytes) -> tuple[AudioFeatures, int | None, str | None]:
-    samples = _prepare_samples(file_bytes)
+def _analyze_audio(source: bytes | Path) -> tuple[AudioFeatures, int | None, str | None]:
+    decoded, sr = _decode_samples(source)
+    samples = _prepare_samples(decoded, sr)
+    # Peak-normalised at the source rate; may share memory with samples when
+    # no resampling was needed, which is fine as both are normalised alike.
+    raw = _normalize_peak(decoded)
     feats = _compute_features(samples)
-    bpm = _estimate_bpm_wavelet(file_bytes) or _estimate_bpm(samples, TARGET_SR)
-    key = _estimate_key_keyfinder_cli(file_bytes)
+    bpm = _estimate_bpm_wavelet(raw, sr) or _estimate_bpm(samples, TARGET_SR)
+    key = _estimate_key_keyfinder_cli(raw, sr)
     return feats, bpm, key
 
 
-def extract_features(file_bytes: bytes) -> AudioFeatures:
-    samples = _prepare_samples(file_bytes)
+def clear_analysis_cache() -> None:
+    with _analysis_lock:
+        _analysis_cache.clear()
+
+
+def _source_digest(source: bytes | Path) -> bytes:
+    if isinstance(source, (bytes, bytearray)):
+        return hashlib.sha256(source).digest()
+    # Chunked by hand: hashlib.file_digest needs Python 3.11.
+    digest = hashlib.sha256()
+    with open(source, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def analyze_audio(
+    source: bytes | Path, digest: bytes | None = None, run: Callable | None = None
+) -> tuple[AudioFeatures, int | None, str | None]:
+    # Identical uploads (retries, the same file for another owner) reuse the
+    # previous decode + feature/BPM/key result. Callers that already hashed
+    # the upload pass its sha256 digest to skip another pass over the data,
+    # and may pass run(fn, *args) to do the analysis elsewhere (e.g. in a
+    # worker process) while the cache stays in this one.
+    if digest is None:
+        digest = _source_digest(source)
+    with _analysis_lock:
+        cached = _analysis_cache.get(digest)
+        if cached is not None:
+            _analysis_cache.move_to_end(digest)
+            return cached
+
+    result = run(_analyze_audio, source) if run is not None else _analyze_audio(source)
+    result[0].vector.setflags(write=False)
+    with _analysis_lock:
+        _analysis_cache[digest] = result
+        while len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
+    return result
+
+
+def extract_features(source: bytes | Path) -> AudioFeatures:
+    samples = _prepare_samples(*_decode_samples(source))
     return _compute_features(samples)
 
 
-def cosine_similarity(a: list[float], b: list[float]) -> float:
-    dot = sum(x * y for x, y in zip(a, b))
-    na = math.sqrt(sum(x * x for x in a))
-    nb = math.sqrt(sum(y * y for y in b))
-    return dot / ((na * nb) + 1e-8)
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    return float(a @ b / ((np.linalg.norm(a) * np.linalg.norm(b)) + 1e-8))
@@ -1,16 +1,24 @@
 from __future__ import annotations
 
+import hashlib
 import json
 import mimetypes
+import os
 import platform
 import shutil
+import signal
 import sys
+import tempfile
+import threading
+import time
 import traceback
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from urllib.parse import parse_qs, urlparse
-import cgi
+
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import BaseTarget, ValueTarget
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 if str(BASE_DIR) not in sys.path:
@@ -20,21 +28,99 @@ from app.service import TuneFindService
 from app.audio import _find_keyfinder_cli
 
 WEB_DIR = BASE_DIR / "web"
+FORM_FIELDS = ("owner_id", "bpm", "key", "skip_duplicates", "top_k", "beat_id")
+READ_CHUNK_SIZE = 64 * 1024
+DIAGNOSTICS_TTL_S = 5.0
+
+_diagnostics_cache: tuple[float, dict] | None = None
+_diagnostics_lock = threading.Lock()
+
+
+def _guess_mime(name: str) -> str:
+    mime, _ = mimetypes.guess_type(name)
+    return mime or "application/octet-stream"
+
+
+def _load_static_assets(web_dir: Path) -> dict[str, tuple[bytes, str, str]]:
+    # URL path -> (body, Content-Type, ETag), read once at startup so GETs for
+    # the UI are a dict lookup. Only files that exist under web_dir are
+    # reachable, which also rules out "../" escapes.
+    assets = {}
+    for path in sorted(web_dir.rglob("*")):
+        if not path.is_file():
+            continue
+        body = path.read_bytes()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        assets["/" + path.relative_to(web_dir).as_posix()] = (body, _guess_mime(path.name), etag)
+    if "/index.html" in assets:
+        assets["/"] = assets["/index.html"]
+    return assets
+
+
+# Streams every part posted under one field name into its own temp file.
+class FilePartsTarget(BaseTarget):
+    # Spools each file part to disk and sha256-hashes it on the way through,
+    # so the service never has to re-read an upload just to hash it.
+    def __init__(self, directory: str) -> None:
+        super().__init__()
+        self.directory = directory
+        self.parts: list[tuple[str, Path, str]] = []
+        self._fd = None
+        self._hash = None
+
+    def on_start(self) -> None:
+        self._fd = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)
+        self._hash = hashlib.sha256()
+
+    def on_data_received(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+        self._fd.write(chunk)
+
+    def on_finish(self) -> None:
+        self._fd.close()
+        self.parts.append((self.multipart_filename or "", Path(self._fd.name), self._hash.hexdigest()))
 
 
 class TuneFindHandler(BaseHTTPRequestHandler):
     server_version = "TuneFindHTTP/0.1"
 
     def _service(self) -> TuneFindService:
-        return TuneFindService(Path(self.server.data_dir))
+        return self.server.service
 
     def _send_json(self, payload: dict, status: int = 200) -> None:
-        body = json.dumps(payload).encode("utf-8")
+        # Encode incrementally. Bodies that fit in one chunk get a normal
+        # Content-Length; larger ones (e.g. big upload lists) are streamed in
+        # READ_CHUNK_SIZE writes and delimited by closing the connection,
+        # since this HTTP/1.0 server can't use chunked encoding.
+        pieces = json.JSONEncoder().iterencode(payload)
+        buffered: list[str] = []
+        size = 0
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            if size >= READ_CHUNK_SIZE:
+                break
+        else:
+            body = "".join(buffered).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
+        self.close_connection = True
         self.end_headers()
-        self.wfile.write(body)
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            if size >= READ_CHUNK_SIZE:
+                self.wfile.write("".join(buffered).encode("utf-8"))
+                buffered = []
+                size = 0
+        self.wfile.write("".join(buffered).encode("utf-8"))
 
     def _safe_json_error(self, err: Exception, status: int = 500) -> None:
         try:
@@ -42,7 +128,34 @@ class TuneFindHandler(BaseHTTPRequestHandler):
         except Exception:
             pass
 
+    def _parse_form(self, tmp_dir: str) -> tuple[dict[str, str | None], list[tuple[str, Path, str]]]:
+        parser = StreamingFormDataParser(headers=self.headers)
+        values = {name: ValueTarget() for name in FORM_FIELDS}
+        for name, target in values.items():
+            parser.register(name, target)
+        files = FilePartsTarget(tmp_dir)
+        parser.register("file", files)
+
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            parser.data_received(chunk)
+            remaining -= len(chunk)
+
+        form = {name: target.value.decode("utf-8") or None for name, target in values.items()}
+        return form, files.parts
+
     def _diagnostics(self) -> dict:
+        global _diagnostics_cache
+        with _diagnostics_lock:
+            now = time.monotonic()
+            if _diagnostics_cache is None or now - _diagnostics_cache[0] >= DIAGNOSTICS_TTL_S:
+                _diagnostics_cache = (now, self._collect_diagnostics())
+            return _diagnostics_cache[1]
+
+    def _collect_diagnostics(self) -> dict:
         try:
             import pydub  # noqa: F401
             pydub_ok = True
@@ -62,25 +175,30 @@ class TuneFindHandler(BaseHTTPRequestHandler):
             "pydub": pydub_ok,
         }
 
-    def _send_file(self, path: Path) -> None:
-        if not path.exists():
+    def _send_asset(self, path: str) -> None:
+        asset = self.server.static_assets.get(path)
+        if asset is None:
             self.send_error(HTTPStatus.NOT_FOUND, "Not found")
             return
-        content = path.read_bytes()
-        mime, _ = mimetypes.guess_type(path.name)
+        body, content_type, etag = asset
+        if etag in {tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")}:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
         self.send_response(HTTPStatus.OK)
-        self.send_header("Content-Type", mime or "application/octet-stream")
-        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
         self.end_headers()
-        self.wfile.write(content)
+        self.wfile.write(body)
 
     def do_GET(self) -> None:  # noqa: N802 - stdlib naming
         try:
             parsed = urlparse(self.path)
-            if parsed.path in {"/", "/index.html"}:
-                return self._send_file(WEB_DIR / "index.html")
-            if parsed.path.startswith("/static/"):
-                return self._send_file(WEB_DIR / parsed.path.removeprefix("/static/"))
+            if parsed.path == "/" or parsed.path == "/index.html" or parsed.path.startswith("/static/"):
+                return self._send_asset(parsed.path)
             if parsed.path == "/health":
                 return self._send_json({"status": "ok"})
             if parsed.path == "/diagnostics":
@@ -107,72 +225,99 @@ class TuneFindHandler(BaseHTTPRequestHandler):
                 self.send_error(HTTPStatus.NOT_FOUND, "Not found")
                 return
 
-            ctype, _ = cgi.parse_header(self.headers.get("Content-Type", ""))
+            ctype = self.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
             if ctype != "multipart/form-data":
                 self.send_error(HTTPStatus.BAD_REQUEST, "Expected multipart/form-data")
                 return
+            if "Content-Length" not in self.headers:
+                self.send_error(HTTPStatus.LENGTH_REQUIRED, "Content-Length is required")
+                return
 
-            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={"REQUEST_METHOD": "POST"})
-            owner_id = form.getfirst("owner_id")
-            if not owner_id:
-                return self._send_json({"error": "owner_id is required"}, status=400)
-            bpm_raw = form.getfirst("bpm")
-            bpm = int(bpm_raw) if bpm_raw and bpm_raw.isdigit() else None
-            key = form.getfirst("key") or None
-            skip_duplicates = form.getfirst("skip_duplicates") == "1"
-
-            file_item = form["file"] if "file" in form else None
-            if file_item is None:
-                return self._send_json({"error": "file is required"}, status=400)
-
-            service = self._service()
-
-            try:
-                if parsed.path == "/upload":
-                    files = []
-                    if isinstance(file_item, list):
-                        for item in file_item:
-                            if not item.file or not item.filename:
-                                continue
-                            files.append((item.filename, item.file.read()))
-                    else:
-                        if file_item.file is None or not file_item.filename:
-                            return self._send_json({"error": "file is required"}, status=400)
-                        files.append((file_item.filename, file_item.file.read()))
-
-                    if not files:
-                        return self._send_json({"error": "file is required"}, status=400)
-
-                    result = service.upload_beats(owner_id, files, bpm=bpm, key=key, skip_duplicates=skip_duplicates)
-                elif parsed.path == "/search":
-                    top_k = form.getfirst("top_k", "5")
-                    if file_item.file is None:
-                        return self._send_json({"error": "file is required"}, status=400)
-                    result = service.search_by_hum(owner_id, file_item.file.read(), top_k=int(top_k))
-                elif parsed.path == "/uploads/delete-one":
-                    beat_id = form.getfirst("beat_id")
-                    if not beat_id:
-                        return self._send_json({"error": "beat_id is required"}, status=400)
-                    result = service.delete_upload(owner_id, beat_id)
-                else:
-                    result = service.delete_uploads(owner_id)
-            except ValueError as err:
-                return self._send_json({"error": str(err)}, status=400)
-            except Exception as err:
-                traceback.print_exc()
-                return self._send_json({"error": str(err)}, status=500)
-
-            self._send_json(result, status=200)
+            # Spool under the data dir so accepted uploads are renamed into
+            # place rather than copied across filesystems.
+            data_dir = self._service().data_dir
+            data_dir.mkdir(parents=True, exist_ok=True)
+            with tempfile.TemporaryDirectory(prefix="tunefind-upload-", dir=data_dir) as tmp_dir:
+                form, file_parts = self._parse_form(tmp_dir)
+                self._handle_form(parsed.path, form, file_parts)
         except Exception as err:
             traceback.print_exc()
             self._safe_json_error(err)
 
+    def _handle_form(self, path: str, form: dict[str, str | None], file_parts: list[tuple[str, Path, str]]) -> None:
+        owner_id = form["owner_id"]
+        if not owner_id:
+            return self._send_json({"error": "owner_id is required"}, status=400)
+        bpm_raw = form["bpm"]
+        bpm = int(bpm_raw) if bpm_raw and bpm_raw.isdigit() else None
+        key = form["key"]
+        skip_duplicates = form["skip_duplicates"] == "1"
+
+        if not file_parts:
+            return self._send_json({"error": "file is required"}, status=400)
+
+        service = self._service()
+
+        try:
+            if path == "/upload":
+                named = [part for part in file_parts if part[0]]
+                if not named:
+                    return self._send_json({"error": "file is required"}, status=400)
+
+                result = service.upload_beats(
+                    owner_id,
+                    [(filename, part) for filename, part, _ in named],
+                    bpm=bpm,
+                    key=key,
+                    skip_duplicates=skip_duplicates,
+                    move_source=True,
+                    audio_hashes=[digest for _, _, digest in named],
+                )
+            elif path == "/search":
+                top_k = form["top_k"] or "5"
+                _, hum_path, hum_hash = file_parts[0]
+                result = service.search_by_hum(owner_id, hum_path, top_k=int(top_k), audio_hash=hum_hash)
+            elif path == "/uploads/delete-one":
+                beat_id = form["beat_id"]
+                if not beat_id:
+                    return self._send_json({"error": "beat_id is required"}, status=400)
+                result = service.delete_upload(owner_id, beat_id)
+            else:
+                result = service.delete_uploads(owner_id)
+        except ValueError as err:
+            return self._send_json({"error": str(err)}, status=400)
+        except Exception as err:
+            traceback.print_exc()
+            return self._send_json({"error": str(err)}, status=500)
+
+        self._send_json(result, status=200)
+
+
+def _exit_on_sigterm(signum, frame) -> None:
+    raise SystemExit(128 + signum)
+
 
-def run(host: str = "0.0.0.0", port: int = 8000, data_dir: str = "data") -> None:
-    httpd = HTTPServer((host, port), TuneFindHandler)
-    httpd.data_dir = data_dir
+def run(host: str = "0.0.0.0", port: int = 8000, data_dir: str = "data", workers: int | None = None) -> None:
+    # A thread per request, so a slow upload's analysis doesn't stall
+    # searches and page loads behind it.
+    httpd = ThreadingHTTPServer((host, port), TuneFindHandler)
+    httpd.static_assets = _load_static_assets(WEB_DIR)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # One service (and in-memory index) for the whole process; the index
+    # re-reads beats.json only when the file changes on disk. Audio analysis
+    # goes to its worker processes; 0 keeps it on the request thread.
+    httpd.service = TuneFindService(Path(data_dir), workers=workers)
+    if threading.current_thread() is threading.main_thread():
+        # systemd/docker stop with SIGTERM; turn it into SystemExit so the
+        # finally below shuts the worker processes down.
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
     print(f"TuneFind server running on http://{host}:{port}")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.service.close()
+        httpd.server_close()
 
 
 if __name__ == "__main__":
@@ -182,6 +327,7 @@ if __name__ == "__main__":
     parser.add_argument("--host", default="0.0.0.0")
     parser.add_argument("--port", type=int, default=8000)
     parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--workers", type=int, default=None, help="Analysis worker processes (0 = in-process)")
     args = parser.parse_args()
 
-    run(args.host, args.port, args.data_dir)
+    run(args.host, args.port, args.data_dir, args.workers)
@@ -1,105 +1,235 @@
 from __future__ import annotations
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
 from pathlib import Path
 from uuid import uuid4
-import hashlib
+import os
+import shutil
+import threading
 
-from app.audio import analyze_audio, extract_features
+import numpy as np
+
+from app.audio import _source_digest, analyze_audio, extract_features, set_analysis_threads
 from app.store import BeatIndex, BeatRecord
 
+# Stored uploads get the mode a plain open() would give them, not the 0600 of
+# the spooled temp files the server moves into place.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+ALLOWED_EXTENSIONS = frozenset({".wav", ".mp3", ".webm", ".ogg", ".m4a"})
+
+# (owner_id, sha256 of the hum, top_k) -> result, for byte-identical re-searches.
+SEARCH_CACHE_SIZE = 256
+QUERY_CACHE_SIZE = 1024
+
+
+def _sha256_hex(source: bytes | Path) -> str:
+    return _source_digest(source).hex()
+
 
 class TuneFindService:
-    def __init__(self, data_dir: Path) -> None:
+    def __init__(self, data_dir: Path, workers: int = 0) -> None:
         self.data_dir = data_dir
+        # Optional process pool for decode + feature extraction, so CPU-bound
+        # analysis runs outside the request threads' GIL. 0 runs it inline.
+        self.workers = workers
+        self.executor = self._start_pool()
+        self._executor_lock = threading.Lock()
         self.uploads_dir = data_dir / "uploads"
         self.index = BeatIndex(data_dir / "index" / "beats.json")
+        # (owner_id, top_k, int8 bucket) -> (index generation, matches)
+        self._query_cache: OrderedDict[tuple, tuple] = OrderedDict()
+        self._search_cache: OrderedDict[tuple[str, str, int], tuple] = OrderedDict()
+        self._query_cache_lock = threading.Lock()
 
     def upload_beat(
         self,
         owner_id: str,
         filename: str,
-        file_bytes: bytes,
+        source: bytes | Path,
         bpm: int | None = None,
         key: str | None = None,
         skip_duplicates: bool = False,
+        move_source: bool = False,
+        audio_hash: str | None = None,
     ) -> dict:
-        lower_name = filename.lower()
-        if not (
-            lower_name.endswith(".wav")
-            or lower_name.endswith(".mp3")
-            or lower_name.endswith(".webm")
-            or lower_name.endswith(".ogg")
-            or lower_name.endswith(".m4a")
-        ):
+        if os.path.splitext(filename)[1].lower() not in ALLOWED_EXTENSIONS:
             raise ValueError("Only .wav, .mp3, .webm, .ogg, and .m4a files are supported in this MVP.")
 
-        audio_hash = hashlib.sha256(file_bytes).hexdigest()
+        # The server hashes uploads while receiving them and passes audio_hash.
+        if audio_hash is None:
+            audio_hash = _sha256_hex(source)
         existing = self.index.find_by_owner_hash(owner_id, audio_hash)
         if existing:
             if skip_duplicates:
                 return {"skipped": True, "filename": filename, "duplicate_of": existing.filename}
             raise ValueError(f"Duplicate upload detected: {existing.filename}")
 
-        feats, est_bpm, est_key = analyze_audio(file_bytes)
+        # The analysis cache lives in this process; only misses go to a worker.
+        feats, est_bpm, est_key = analyze_audio(source, bytes.fromhex(audio_hash), run=self._run)
         beat_id = str(uuid4())
         bpm = bpm if bpm is not None else est_bpm
         key = key if key else est_key
 
-        owner_dir = self.uploads_dir / owner_id
-        owner_dir.mkdir(parents=True, exist_ok=True)
-        (owner_dir / f"{beat_id}_{filename}").write_bytes(file_bytes)
-
-        self.index.upsert(
-            BeatRecord(
-                beat_id=beat_id,
-                filename=filename,
-                owner_id=owner_id,
-                duration_s=feats.duration_s,
-                sample_rate=feats.sample_rate,
-                vector=feats.vector,
-                audio_hash=audio_hash,
-                bpm=bpm,
-                key=key,
-            )
+        record = BeatRecord(
+            beat_id=beat_id,
+            filename=filename,
+            owner_id=owner_id,
+            duration_s=feats.duration_s,
+            sample_rate=feats.sample_rate,
+            vector=feats.vector,
+            audio_hash=audio_hash,
+            bpm=bpm,
+            key=key,
         )
+        # The check above only saves the analysis; this one is authoritative,
+        # since concurrent requests may have uploaded the same audio meanwhile.
+        existing = self.index.insert_unless_duplicate(record)
+        if existing:
+            if skip_duplicates:
+                return {"skipped": True, "filename": filename, "duplicate_of": existing.filename}
+            raise ValueError(f"Duplicate upload detected: {existing.filename}")
+
+        owner_dir = self.uploads_dir / owner_id
+        stored_path = owner_dir / f"{beat_id}_{filename}"
+        try:
+            owner_dir.mkdir(parents=True, exist_ok=True)
+            if isinstance(source, (bytes, bytearray)):
+                stored_path.write_bytes(source)
+            elif move_source:
+                # Spooled uploads are handed over; a rename when on the same disk.
+                shutil.move(source, stored_path)
+                os.chmod(stored_path, 0o666 & ~_UMASK)
+            else:
+                shutil.copyfile(source, stored_path)
+        except BaseException:
+            self.index.delete_by_owner_and_id(owner_id, beat_id)
+            raise
         return {"beat_id": beat_id, "filename": filename, "owner_id": owner_id}
 
     def upload_beats(
         self,
         owner_id: str,
-        files: list[tuple[str, bytes]],
+        files: list[tuple[str, bytes | Path]],
         bpm: int | None = None,
         key: str | None = None,
         skip_duplicates: bool = False,
+        move_source: bool = False,
+        audio_hashes: list[str | None] | None = None,
     ) -> dict:
+        if audio_hashes is None:
+            audio_hashes = [None] * len(files)
         uploaded = []
         skipped = []
         failed = []
-        for filename, file_bytes in files:
-            try:
-                result = self.upload_beat(
-                    owner_id,
-                    filename,
-                    file_bytes,
-                    bpm=bpm,
-                    key=key,
-                    skip_duplicates=skip_duplicates,
-                )
-                if result.get("skipped"):
-                    skipped.append(result)
-                else:
-                    uploaded.append(result)
-            except Exception as err:
-                failed.append({"filename": filename, "error": str(err)})
+        with self.index.batch():
+            for (filename, source), audio_hash in zip(files, audio_hashes):
+                try:
+                    result = self.upload_beat(
+                        owner_id,
+                        filename,
+                        source,
+                        bpm=bpm,
+                        key=key,
+                        skip_duplicates=skip_duplicates,
+                        move_source=move_source,
+                        audio_hash=audio_hash,
+                    )
+                    if result.get("skipped"):
+                        skipped.append(result)
+                    else:
+                        uploaded.append(result)
+                except Exception as err:
+                    failed.append({"filename": filename, "error": str(err)})
         return {"uploads": uploaded, "skipped": skipped, "failed": failed, "count": len(uploaded)}
 
-    def search_by_hum(self, owner_id: str, file_bytes: bytes, top_k: int = 5) -> dict:
+    def search_by_hum(
+        self, owner_id: str, source: bytes | Path, top_k: int = 5, audio_hash: str | None = None
+    ) -> dict:
         if top_k < 1 or top_k > 20:
             raise ValueError("top_k must be between 1 and 20")
-        query = extract_features(file_bytes)
-        matches = self.index.search(query.vector, owner_id=owner_id, top_k=top_k)
+        if audio_hash is None:
+            audio_hash = _sha256_hex(source)
+        key = (owner_id, audio_hash, top_k)
+        generation = self.index.owner_generation(owner_id)
+        with self._query_cache_lock:
+            cached = self._search_cache.get(key)
+            if cached is not None and cached[0] == generation:
+                self._search_cache.move_to_end(key)
+                return {"matches": [dict(m) for m in cached[1]], "count": len(cached[1])}
+
+        query = self._run(extract_features, source)
+        matches = self._search_cached(query.vector, owner_id, top_k)
+        with self._query_cache_lock:
+            self._search_cache[key] = (generation, [dict(m) for m in matches])
+            self._search_cache.move_to_end(key)
+            while len(self._search_cache) > SEARCH_CACHE_SIZE:
+                self._search_cache.popitem(last=False)
         return {"matches": matches, "count": len(matches)}
 
+    def _start_pool(self) -> ProcessPoolExecutor | None:
+        if self.workers <= 0:
+            return None
+        # Spawned rather than forked: requests submit from handler threads,
+        # and forking a threaded process can copy a held lock into the child.
+        # One wavelet thread per worker; the processes are the parallelism.
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=get_context("spawn"),
+            initializer=set_analysis_threads,
+            initargs=(1,),
+        )
+
+    def _run(self, fn, *args):
+        executor = self.executor
+        if executor is None:
+            return fn(*args)
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. killed on a pathological file), which breaks
+            # the whole pool. Fail this request and start a fresh pool for
+            # the next ones.
+            with self._executor_lock:
+                if self.executor is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self._start_pool()
+            raise RuntimeError("Audio analysis worker crashed; please retry.") from None
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def _search_cached(self, vector: np.ndarray, owner_id: str, top_k: int) -> list[dict]:
+        # Repeat hums land in the same int8 bucket; reuse the ranking as long
+        # as the owner's beats haven't changed since it was computed.
+        unit = np.asarray(vector, dtype=np.float32)
+        unit = unit / (np.linalg.norm(unit) or 1.0)
+        key = (owner_id, top_k, np.round(unit * 127).astype(np.int8).tobytes())
+        generation = self.index.owner_generation(owner_id)
+        with self._query_cache_lock:
+            cached = self._query_cache.get(key)
+            if cached is not None:
+                cached_generation, matches = cached
+                if cached_generation == generation:
+                    self._query_cache.move_to_end(key)
+                    return [dict(m) for m in matches]
+
+        # Approximate (HNSW, exactly re-ranked) for large owners when hnswlib
+        # is installed; an exact scan otherwise.
+        matches = self.index.search(vector, owner_id=owner_id, top_k=top_k, exact=False)
+        with self._query_cache_lock:
+            self._query_cache[key] = (generation, matches)
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return [dict(m) for m in matches]
+
     def list_uploads(self, owner_id: str) -> dict:
         uploads = self.index.list_by_owner(owner_id)
         return {"uploads": uploads, "count": len(uploads)}
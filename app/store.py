@@ -1,11 +1,48 @@
 from __future__ import annotations
 
+import functools
 import json
+import os
+import threading
 import time
+from contextlib import contextmanager
 from dataclasses import asdict, dataclass
 from pathlib import Path
+from typing import Iterator
 
-from app.audio import cosine_similarity
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional: faster (de)serialisation of the index files
+    orjson = None
+
+try:
+    import hnswlib
+except ImportError:  # optional: large owners use the exact scan
+    hnswlib = None
+
+# The log is folded back into the snapshot once it outgrows it by this factor
+# (and is at least LOG_COMPACT_MIN_BYTES, so tiny indexes don't churn).
+LOG_COMPACT_RATIO = 2
+LOG_COMPACT_MIN_BYTES = 64 * 1024
+
+# For search(..., exact=False) with hnswlib installed, owners above this size
+# get an HNSW graph whose HNSW_SHORTLIST nearest rows (at least top_k * 4) are
+# rescored exactly.
+HNSW_MIN_ROWS = 512
+HNSW_SHORTLIST = 64
+
+
+def _locked(method):
+    # The server handles requests on multiple threads; every public entry
+    # point runs under the index's re-entrant lock.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 @dataclass
@@ -15,69 +52,393 @@ class BeatRecord:
     owner_id: str
     duration_s: float
     sample_rate: int
-    vector: list[float]
+    vector: np.ndarray
     audio_hash: str | None = None
     bpm: int | None = None
     key: str | None = None
 
 
+def _json_loads(data: bytes):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":"), default=np.ndarray.tolist).encode("utf-8")
+
+
+def _unit_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+
 class BeatIndex:
     def __init__(self, index_path: Path) -> None:
         self.index_path = index_path
+        self.vectors_path = index_path.with_suffix(".vectors.npy")
+        # Mutations are appended here and replayed over the snapshot on load.
+        self.log_path = index_path.with_suffix(".log.jsonl")
+        # compact() moves the log here while it writes the new snapshot, so
+        # appends from other processes land in a fresh log and nothing that
+        # was only in the old one is lost if we stop half way.
+        self.compacting_path = index_path.with_suffix(".log.compacting.jsonl")
+        # Struct-of-arrays layout: records[i] describes row i of _mat. Rows are
+        # L2-normalised on insert, so cosine search is a plain GEMV.
         self.records: list[BeatRecord] = []
+        self._mat = np.empty((0, 0), dtype=np.float32)
+        # owner_id -> HNSW graph labelled by row, built on first large search.
+        self._hnsw: dict[str, object] = {}
+        # Row lookups, kept in step with records so no query scans the table.
+        self._by_owner: dict[str, list[int]] = {}
+        self._by_id: dict[str, int] = {}
+        self._by_hash: dict[tuple[str, str], int] = {}
+        # Bumped whenever an owner's rows change (and _epoch on every reload),
+        # so callers can tell whether results they cached are still current.
+        self._generation: dict[str, int] = {}
+        self._epoch = 0
+        # (mtime_ns, size) of the snapshot and logs as of our last load or write.
+        self._signature: tuple | None = None
+        self._lock = threading.RLock()
+        # batch() nesting is per thread; each thread's unflushed log lines are
+        # kept (by thread id) so a reload can re-apply them.
+        self._batch = threading.local()
+        self._pending: dict[int, list[bytes]] = {}
         self._load()
 
+    @staticmethod
+    def _stat(path: Path) -> tuple[int, int] | None:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _file_signature(self) -> tuple:
+        return self._stat(self.index_path), self._stat(self.log_path), self._stat(self.compacting_path)
+
+    def _reload_if_stale(self) -> None:
+        # Another process (e.g. the CLI) may have rewritten the index; only
+        # re-parse when the file actually changed since we last saw it.
+        if self._file_signature() != self._signature:
+            self._load()
+
     def _load(self) -> None:
+        self._epoch += 1
+        signature = self._file_signature()
+        data = []
         if self.index_path.exists():
             try:
-                data = json.loads(self.index_path.read_text())
+                data = _json_loads(self.index_path.read_bytes())
             except json.JSONDecodeError:
                 backup = self.index_path.with_name(f"{self.index_path.stem}.corrupt.{int(time.time())}.json")
                 self.index_path.rename(backup)
-                self.records = []
+                signature = self._file_signature()
+                data = []
+        matrix = None
+        # Indexes written before the .npy sidecar carry vectors inline.
+        if data and "vector" not in data[0]:
+            try:
+                # Read fully rather than memory-mapping: records keep views
+                # into this array, and an open map would block os.replace()
+                # of the sidecar on Windows.
+                matrix = np.load(self.vectors_path)
+            except (FileNotFoundError, ValueError):
+                matrix = None
+            if matrix is None or matrix.ndim != 2 or len(matrix) != len(data):
+                # Caught a writer between the two files; keep what we have
+                # and look again on the next call.
+                self._signature = None
                 return
-            self.records = []
-            for item in data:
-                if "audio_hash" not in item:
-                    item["audio_hash"] = None
-                if "bpm" not in item:
-                    item["bpm"] = None
-                if "key" not in item:
-                    item["key"] = None
-                self.records.append(BeatRecord(**item))
+        self.records = []
+        for i, item in enumerate(data):
+            if "audio_hash" not in item:
+                item["audio_hash"] = None
+            if "bpm" not in item:
+                item["bpm"] = None
+            if "key" not in item:
+                item["key"] = None
+            if matrix is None:
+                item["vector"] = np.asarray(item["vector"], dtype=np.float32)
+            else:
+                item["vector"] = matrix[i]
+            self.records.append(BeatRecord(**item))
+        self._signature = signature
+        self._rebuild_columns(matrix)
+        for path in (self.compacting_path, self.log_path):
+            try:
+                self._replay(path.read_bytes().splitlines())
+            except FileNotFoundError:
+                pass
+        # Edits still buffered by open batches were only in the memory we
+        # just replaced.
+        for lines in self._pending.values():
+            self._replay(lines)
+
+    def _replay(self, lines: list[bytes]) -> None:
+        # Runs of deletes are applied as one row compaction rather than one
+        # O(N) compaction per beat.
+        deleted: list[str] = []
+        for line in lines:
+            try:
+                entry = _json_loads(line)
+            except json.JSONDecodeError:
+                # Torn final line from an interrupted append.
+                continue
+            if entry.get("op") == "upsert":
+                self._apply_deletes(deleted)
+                deleted = []
+                item = entry["record"]
+                item["vector"] = np.asarray(item["vector"], dtype=np.float32)
+                self._apply_upsert(BeatRecord(**item))
+            elif entry.get("op") == "delete":
+                deleted.extend(entry["beat_ids"] if "beat_ids" in entry else [entry["beat_id"]])
+        self._apply_deletes(deleted)
+
+    def _rebuild_columns(self, matrix: np.ndarray | None = None) -> None:
+        n = len(self.records)
+        if matrix is not None:
+            # A copy, since _mat is edited in place and records view matrix.
+            self._mat = _unit_rows(matrix)
+        else:
+            dim = len(self.records[0].vector) if n else 0
+            self._mat = np.empty((n, dim), dtype=np.float32)
+            for i, record in enumerate(self.records):
+                self._mat[i] = record.vector
+            if n:
+                self._mat = _unit_rows(self._mat)
+        self._reindex()
+
+    def _reindex(self, changed_owners: set[str] | None = None) -> None:
+        # Graph labels are positions in the owner's row list, which only
+        # shift for owners that lost rows; other owners' graphs stay valid.
+        if changed_owners is None:
+            self._hnsw.clear()
+        else:
+            for owner_id in changed_owners:
+                self._hnsw.pop(owner_id, None)
+        self._by_owner = {}
+        self._by_id = {}
+        self._by_hash = {}
+        for row, record in enumerate(self.records):
+            self._index_row(row, record)
+
+    def _index_row(self, row: int, record: BeatRecord) -> None:
+        self._by_owner.setdefault(record.owner_id, []).append(row)
+        self._by_id[record.beat_id] = row
+        if record.audio_hash:
+            self._by_hash.setdefault((record.owner_id, record.audio_hash), row)
+
+    def _append_row(self, record: BeatRecord) -> None:
+        vector = np.asarray(record.vector, dtype=np.float32)
+        n = len(self.records)
+        if self._mat.shape[1] != len(vector):
+            self.records.append(record)
+            self._rebuild_columns()
+            return
+        if n == len(self._mat):
+            # Grow by doubling so a run of inserts stays amortised O(1).
+            capacity = max(2 * n, 16)
+            mat = np.empty((capacity, self._mat.shape[1]), dtype=np.float32)
+            mat[:n] = self._mat[:n]
+            self._mat = mat
+        self._mat[n] = _unit_rows(vector[None, :])[0]
+        self.records.append(record)
+        self._index_row(n, record)
+        graph = self._hnsw.get(record.owner_id)
+        if graph is not None:
+            if graph.get_current_count() >= graph.get_max_elements():
+                graph.resize_index(2 * graph.get_max_elements())
+            graph.add_items(self._mat[n : n + 1], [len(self._by_owner[record.owner_id]) - 1])
+
+    def _remove_rows(self, keep: np.ndarray) -> None:
+        n = len(self.records)
+        changed = {r.owner_id for r, k in zip(self.records, keep) if not k}
+        self.records = [r for r, k in zip(self.records, keep) if k]
+        m = len(self.records)
+        self._mat[:m] = self._mat[:n][keep]
+        # Compaction shifts rows, so the lookups are rebuilt (O(N) like the
+        # compaction itself).
+        self._reindex(changed)
+
+    def _touch(self, owner_id: str) -> None:
+        self._generation[owner_id] = self._generation.get(owner_id, 0) + 1
+
+    def _apply_upsert(self, record: BeatRecord) -> None:
+        row = self._by_id.get(record.beat_id)
+        if row is not None:
+            self._touch(self.records[row].owner_id)
+            self._remove_rows(np.arange(len(self.records)) != row)
+        self._append_row(record)
+        self._touch(record.owner_id)
+
+    def _apply_deletes(self, beat_ids: list[str]) -> list[BeatRecord]:
+        rows = sorted({self._by_id[b] for b in beat_ids if b in self._by_id})
+        if not rows:
+            return []
+        removed = [self.records[row] for row in rows]
+        keep = np.ones(len(self.records), dtype=bool)
+        keep[rows] = False
+        self._remove_rows(keep)
+        for owner_id in {r.owner_id for r in removed}:
+            self._touch(owner_id)
+        return removed
+
+    def _log(self, *entries: dict) -> None:
+        lines = [_json_dumps(e) + b"\n" for e in entries]
+        if getattr(self._batch, "depth", 0):
+            self._pending.setdefault(threading.get_ident(), []).extend(lines)
+        else:
+            self._append(lines)
+
+    def _append(self, lines: list[bytes]) -> None:
+        if not lines:
+            return
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        if self._file_signature() != self._signature:
+            # Another writer got in since we last looked. Read its changes
+            # first so our stamps never cover bytes we haven't seen, then
+            # redo ours on top.
+            self._load()
+            self._replay(lines)
+        data = b"".join(lines)
+        before = self._stat(self.log_path)
+        with open(self.log_path, "ab") as handle:
+            handle.write(data)
+        after = self._stat(self.log_path)
+        if after[1] == (before[1] if before else 0) + len(data):
+            self._signature = self._file_signature()
+        else:
+            # Someone appended alongside us; re-read everything next time.
+            self._signature = None
+        snapshot_size = sum(p.stat().st_size for p in (self.index_path, self.vectors_path) if p.exists())
+        if after[1] > max(LOG_COMPACT_RATIO * snapshot_size, LOG_COMPACT_MIN_BYTES):
+            self.compact()
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        # Defer this thread's log writes until its outermost batch exits, so
+        # K uploads cost one append instead of K. Other threads (and their
+        # reloads) are unaffected.
+        depth = getattr(self._batch, "depth", 0)
+        self._batch.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._batch.depth = depth
+            if depth == 0:
+                with self._lock:
+                    self._append(self._pending.pop(threading.get_ident(), []))
+
+    @_locked
+    def compact(self) -> None:
+        self._reload_if_stale()
+        if self.log_path.exists():
+            seen = self._signature[1][1] if self._signature and self._signature[1] else 0
+            os.replace(self.log_path, self.compacting_path)
+            # Pick up anything appended between the staleness check and the
+            # rename.
+            with open(self.compacting_path, "rb") as handle:
+                handle.seek(seen)
+                self._replay(handle.read().splitlines())
+        self._save()
+        # The snapshot now covers the moved log. Replay is idempotent, so a
+        # crash before this unlink only costs a redundant replay.
+        self.compacting_path.unlink(missing_ok=True)
+        self._signature = self._file_signature()
 
     def _save(self) -> None:
         self.index_path.parent.mkdir(parents=True, exist_ok=True)
-        self.index_path.write_text(json.dumps([asdict(r) for r in self.records], indent=2))
+        # Vectors first, then the metadata that references them, each swapped
+        # in atomically so readers never see a half-written file.
+        tmp_vectors = self.vectors_path.with_name(self.vectors_path.name + ".tmp")
+        with open(tmp_vectors, "wb") as handle:
+            np.save(handle, np.ascontiguousarray(self._mat[: len(self.records)]))
+        os.replace(tmp_vectors, self.vectors_path)
+        payload = [{k: v for k, v in asdict(r).items() if k != "vector"} for r in self.records]
+        tmp_index = self.index_path.with_name(self.index_path.name + ".tmp")
+        tmp_index.write_bytes(_json_dumps(payload))
+        os.replace(tmp_index, self.index_path)
+        self._signature = self._file_signature()
 
+    @_locked
     def upsert(self, record: BeatRecord) -> None:
-        self.records = [r for r in self.records if r.beat_id != record.beat_id]
-        self.records.append(record)
-        self._save()
+        self._reload_if_stale()
+        self._apply_upsert(record)
+        item = asdict(record)
+        item["vector"] = np.ascontiguousarray(record.vector, dtype=np.float32)
+        self._log({"op": "upsert", "record": item})
 
-    def find_by_owner_hash(self, owner_id: str, audio_hash: str) -> BeatRecord | None:
-        for record in self.records:
-            if record.audio_hash and record.owner_id == owner_id and record.audio_hash == audio_hash:
-                return record
+    @_locked
+    def insert_unless_duplicate(self, record: BeatRecord) -> BeatRecord | None:
+        # Check and insert under one lock hold, so two requests carrying the
+        # same audio for the same owner can't both get in. Returns the
+        # existing record instead of inserting when there is one.
+        self._reload_if_stale()
+        row = self._by_hash.get((record.owner_id, record.audio_hash))
+        if record.audio_hash and row is not None:
+            return self.records[row]
+        self.upsert(record)
         return None
 
-    def search(self, query_vector: list[float], owner_id: str, top_k: int = 5) -> list[dict]:
-        candidates = [r for r in self.records if r.owner_id == owner_id]
-        scored = [(cosine_similarity(query_vector, c.vector), c) for c in candidates]
-        scored.sort(key=lambda x: x[0], reverse=True)
-        return [
-            {
-                "beat_id": item.beat_id,
-                "filename": item.filename,
-                "owner_id": item.owner_id,
-                "duration_s": item.duration_s,
-                "score": round(score, 4),
-            }
-            for score, item in scored[:top_k]
-        ]
+    @_locked
+    def owner_generation(self, owner_id: str) -> tuple[int, int]:
+        self._reload_if_stale()
+        return self._epoch, self._generation.get(owner_id, 0)
 
+    @_locked
+    def find_by_owner_hash(self, owner_id: str, audio_hash: str) -> BeatRecord | None:
+        self._reload_if_stale()
+        row = self._by_hash.get((owner_id, audio_hash))
+        return self.records[row] if row is not None else None
+
+    @_locked
+    def search(self, query_vector: np.ndarray, owner_id: str, top_k: int = 5, exact: bool = True) -> list[dict]:
+        self._reload_if_stale()
+        rows = self._by_owner.get(owner_id)
+        if not rows:
+            return []
+        rows = np.asarray(rows)
+        # Normalise the query once; stored rows already are.
+        query = _unit_rows(np.asarray(query_vector, dtype=np.float32)[None, :])[0]
+        if not exact and hnswlib is not None and len(rows) > HNSW_MIN_ROWS:
+            shortlist = max(HNSW_SHORTLIST, top_k * 4)
+            graph = self._owner_graph(owner_id, rows)
+            graph.set_ef(2 * shortlist)
+            labels, _ = graph.knn_query(query[None, :], k=shortlist)
+            rows = rows[np.sort(labels[0].astype(np.int64))]
+        scores = self._mat[rows] @ query
+        # O(N) partial selection, then order just the k winners (ties by row).
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(k)
+        order = top[np.lexsort((top, -scores[top]))]
+        results = []
+        for i in order:
+            record = self.records[rows[i]]
+            results.append(
+                {
+                    "beat_id": record.beat_id,
+                    "filename": record.filename,
+                    "owner_id": record.owner_id,
+                    "duration_s": record.duration_s,
+                    "score": round(float(scores[i]), 4),
+                }
+            )
+        return results
+
+    def _owner_graph(self, owner_id: str, rows: np.ndarray):
+        graph = self._hnsw.get(owner_id)
+        if graph is None:
+            graph = hnswlib.Index(space="ip", dim=self._mat.shape[1])
+            graph.init_index(max_elements=2 * len(rows), ef_construction=200, M=16)
+            graph.add_items(self._mat[rows], np.arange(len(rows)))
+            self._hnsw[owner_id] = graph
+        return graph
+
+    @_locked
     def list_by_owner(self, owner_id: str) -> list[dict]:
-        items = [r for r in self.records if r.owner_id == owner_id]
+        self._reload_if_stale()
+        items = [self.records[row] for row in self._by_owner.get(owner_id, ())]
         items.sort(key=lambda r: r.filename.lower())
         return [
             {
@@ -92,22 +453,22 @@ class BeatIndex:
             for item in items
         ]
 
+    @_locked
     def delete_by_owner(self, owner_id: str) -> list[BeatRecord]:
-        removed = [r for r in self.records if r.owner_id == owner_id]
-        if removed:
-            self.records = [r for r in self.records if r.owner_id != owner_id]
-            self._save()
+        self._reload_if_stale()
+        rows = self._by_owner.get(owner_id)
+        if not rows:
+            return []
+        removed = self._apply_deletes([self.records[row].beat_id for row in rows])
+        self._log({"op": "delete", "beat_ids": [r.beat_id for r in removed]})
         return removed
 
+    @_locked
     def delete_by_owner_and_id(self, owner_id: str, beat_id: str) -> BeatRecord | None:
-        removed = None
-        remaining = []
-        for record in self.records:
-            if record.owner_id == owner_id and record.beat_id == beat_id:
-                removed = record
-                continue
-            remaining.append(record)
-        if removed:
-            self.records = remaining
-            self._save()
-        return removed
+        self._reload_if_stale()
+        row = self._by_id.get(beat_id)
+        if row is None or self.records[row].owner_id != owner_id:
+            return None
+        record = self._apply_deletes([beat_id])[0]
+        self._log({"op": "delete", "beat_id": beat_id})
+        return record
@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import os
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def main() -> None:
+    try:
+        from Cython.Build import cythonize
+        from setuptools import Extension, setup
+    except ImportError:
+        print("Building the DSP extension requires Cython and setuptools: pip install cython setuptools")
+        sys.exit(1)
+
+    if os.name == "nt":
+        compile_args = ["/O2", "/fp:fast"]
+    else:
+        compile_args = ["-O3", "-march=native", "-ffast-math"]
+
+    extension = Extension(
+        "app._dsp",
+        [str(Path("app") / "_dsp.pyx")],
+        extra_compile_args=compile_args,
+    )
+    os.chdir(ROOT_DIR)
+    setup(
+        name="tunefind-dsp",
+        ext_modules=cythonize([extension]),
+        script_args=["build_ext", "--inplace"],
+    )
+    print("DSP extension built.")
+
+
+if __name__ == "__main__":
+    main()
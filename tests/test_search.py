@@ -1,29 +1,35 @@
+import hashlib
+import http.client
 import io
-import math
+import json
 import os
 import stat
+import threading
 import wave
+from http.server import ThreadingHTTPServer
 
+import numpy as np
 import pytest
+from streaming_form_data import StreamingFormDataParser
 
 import app.audio as audio
+import app.service as service_module
+from app.server import FilePartsTarget, TuneFindHandler, _load_static_assets
 from app.service import TuneFindService
+from app.store import BeatIndex, BeatRecord
 
 
 def make_tone(freq: float, seconds: float = 1.0, sr: int = 8000) -> bytes:
     n = int(sr * seconds)
-    frames = bytearray()
-    for i in range(n):
-        t = i / sr
-        val = int(0.4 * 32767 * math.sin(2 * math.pi * freq * t))
-        frames.extend(int(val).to_bytes(2, byteorder="little", signed=True))
+    t = np.arange(n) / sr
+    frames = (0.4 * 32767 * np.sin(2 * np.pi * freq * t)).astype("<i2").tobytes()
 
     buf = io.BytesIO()
     with wave.open(buf, "wb") as wav:
         wav.setnchannels(1)
         wav.setsampwidth(2)
         wav.setframerate(sr)
-        wav.writeframes(bytes(frames))
+        wav.writeframes(frames)
     return buf.getvalue()
 
 
@@ -37,6 +43,28 @@ def mock_keyfinder_cli(monkeypatch, tmp_path):
         script.write_text("#!/usr/bin/env sh\necho C\n")
         script.chmod(script.stat().st_mode | stat.S_IEXEC)
     monkeypatch.setenv("TUNEFIND_KEYFINDER_PATH", str(script))
+    audio.clear_analysis_cache()
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    web_dir = tmp_path / "web"
+    web_dir.mkdir()
+    (web_dir / "index.html").write_text("<html></html>")
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), TuneFindHandler)
+    httpd.static_assets = _load_static_assets(web_dir)
+    httpd.service = TuneFindService(tmp_path / "data")
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def get(httpd, path: str, headers: dict | None = None) -> http.client.HTTPResponse:
+    conn = http.client.HTTPConnection(*httpd.server_address, timeout=10)
+    conn.request("GET", path, headers=headers or {})
+    return conn.getresponse()
 
 
 def test_upload_and_search_returns_expected_top_match(tmp_path):
@@ -66,8 +94,304 @@ def test_owner_isolation(tmp_path):
     assert result["matches"][0]["owner_id"] == "alice"
 
 
+def test_repeated_search_sees_new_uploads(tmp_path):
+    service = TuneFindService(tmp_path)
+    service.upload_beat("alice", "high.wav", make_tone(660.0))
+    assert service.search_by_hum("alice", make_tone(230.0))["count"] == 1
+
+    service.upload_beat("alice", "low.wav", make_tone(220.0))
+
+    result = service.search_by_hum("alice", make_tone(230.0))
+    assert result["count"] == 2
+    assert result["matches"][0]["filename"] == "low.wav"
+
+
+def test_default_search_matches_exact_search(tmp_path):
+    # Real feature vectors are 12-d and tightly clustered; the default search
+    # must rank them exactly like a brute-force cosine scan.
+    rng = np.random.default_rng(0)
+
+    def random_features():
+        noise = rng.standard_normal(audio.TARGET_SR)
+        colored = np.convolve(noise, rng.standard_normal(rng.integers(2, 40)), "same")
+        return audio._compute_features(colored.astype(np.float32)).vector
+
+    index = BeatIndex(tmp_path / "beats.json")
+    vectors = []
+    with index.batch():
+        for i in range(300):
+            vector = random_features()
+            vectors.append(vector / np.linalg.norm(vector))
+            index.upsert(BeatRecord(f"b{i}", f"b{i}.wav", "alice", 1.0, audio.TARGET_SR, vector))
+
+    for _ in range(20):
+        query = random_features()
+        default = index.search(query, "alice", top_k=5)
+        expected = np.argsort(-(np.stack(vectors) @ (query / np.linalg.norm(query))), kind="stable")[:5]
+        assert [m["beat_id"] for m in default] == [f"b{i}" for i in expected]
+
+
+def test_hnsw_search_matches_exact_and_survives_other_owners_deletes(tmp_path):
+    pytest.importorskip("hnswlib")
+    index = BeatIndex(tmp_path / "beats.json")
+    with index.batch():
+        for i in range(600):
+            index.upsert(make_record(f"a{i}", seed=i))
+            if i % 60 == 0:
+                index.upsert(make_record(f"b{i}", owner_id="bob", seed=10_000 + i))
+    queries = [make_record("q", seed=20_000 + i).vector for i in range(20)]
+
+    def assert_matches_exact():
+        for query in queries:
+            assert index.search(query, "alice", exact=False) == index.search(query, "alice")
+
+    assert_matches_exact()
+    graph = index._hnsw["alice"]
+    index.delete_by_owner_and_id("bob", "b0")
+    index.upsert(make_record("b1", owner_id="bob", seed=1))
+    assert index._hnsw["alice"] is graph
+    assert_matches_exact()
+
+    index.delete_by_owner_and_id("alice", "a0")
+    index.upsert(make_record("a600", seed=600))
+    assert_matches_exact()
+
+
+def test_index_picks_up_changes_written_by_another_instance(tmp_path):
+    service = TuneFindService(tmp_path)
+    other = BeatIndex(tmp_path / "index" / "beats.json")
+    assert other.list_by_owner("alice") == []
+
+    service.upload_beat("alice", "a.wav", make_tone(220.0))
+
+    assert [u["filename"] for u in other.list_by_owner("alice")] == ["a.wav"]
+
+
+def make_record(beat_id: str, owner_id: str = "alice", seed: int = 0) -> BeatRecord:
+    vector = np.random.default_rng(seed).standard_normal(8).astype(np.float32)
+    return BeatRecord(beat_id, f"{beat_id}.wav", owner_id, 1.0, 8000, vector)
+
+
+def test_index_replays_log_over_snapshot(tmp_path):
+    path = tmp_path / "beats.json"
+    index = BeatIndex(path)
+    for i in range(3):
+        index.upsert(make_record(f"b{i}", seed=i))
+    index.delete_by_owner_and_id("alice", "b1")
+
+    assert index.log_path.exists()
+    assert [u["beat_id"] for u in BeatIndex(path).list_by_owner("alice")] == ["b0", "b2"]
+
+
+def test_compaction_folds_log_into_snapshot(tmp_path):
+    path = tmp_path / "beats.json"
+    index = BeatIndex(path)
+    index.upsert(make_record("b0"))
+    index.upsert(make_record("b1", seed=1))
+    index.compact()
+
+    assert not index.log_path.exists()
+    reloaded = BeatIndex(path)
+    assert [u["beat_id"] for u in reloaded.list_by_owner("alice")] == ["b0", "b1"]
+    assert reloaded.search(make_record("q", seed=1).vector, "alice", top_k=1)[0]["beat_id"] == "b1"
+
+
+def test_batch_and_compaction_keep_writes_from_another_instance(tmp_path):
+    path = tmp_path / "beats.json"
+    first = BeatIndex(path)
+    second = BeatIndex(path)
+    with first.batch():
+        first.upsert(make_record("a1"))
+        second.upsert(make_record("b1", seed=1))
+        first.upsert(make_record("a2", seed=2))
+    first.compact()
+
+    assert [u["beat_id"] for u in BeatIndex(path).list_by_owner("alice")] == ["a1", "a2", "b1"]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX file modes")
+def test_moved_upload_gets_default_file_mode(tmp_path):
+    spooled = tmp_path / "spool.wav"
+    spooled.write_bytes(make_tone(220.0))
+    spooled.chmod(0o600)
+    service = TuneFindService(tmp_path / "data")
+
+    beat = service.upload_beat("alice", "a.wav", spooled, move_source=True)
+
+    umask = os.umask(0)
+    os.umask(umask)
+    stored = tmp_path / "data" / "uploads" / "alice" / f"{beat['beat_id']}_a.wav"
+    assert not spooled.exists()
+    assert stat.S_IMODE(stored.stat().st_mode) == 0o666 & ~umask
+
+
+def test_reload_after_bulk_delete_compacts_rows_once(tmp_path, monkeypatch):
+    path = tmp_path / "beats.json"
+    index = BeatIndex(path)
+    with index.batch():
+        for i in range(200):
+            index.upsert(make_record(f"b{i}", owner_id="alice" if i % 2 else "bob", seed=i))
+    index.compact()
+    index.delete_by_owner("alice")
+    index.delete_by_owner_and_id("bob", "b0")
+
+    reindexes = []
+    real = BeatIndex._reindex
+    monkeypatch.setattr(BeatIndex, "_reindex", lambda self, *args: reindexes.append(1) or real(self, *args))
+    reloaded = BeatIndex(path)
+
+    assert reloaded.list_by_owner("alice") == []
+    assert len(reloaded.list_by_owner("bob")) == 99
+    # One for the snapshot, one for the whole run of logged deletes.
+    assert len(reindexes) == 2
+
+
+def test_concurrent_identical_uploads_store_one_copy(tmp_path, monkeypatch):
+    service = TuneFindService(tmp_path)
+    # Both requests pass the early duplicate check before either finishes.
+    barrier = threading.Barrier(2, timeout=10)
+    real = service_module.analyze_audio
+
+    def analyze_in_step(*args, **kwargs):
+        barrier.wait()
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(service_module, "analyze_audio", analyze_in_step)
+    tone = make_tone(220.0)
+    results, errors = [], []
+
+    def upload():
+        try:
+            results.append(service.upload_beat("alice", "a.wav", tone))
+        except ValueError as err:
+            errors.append(str(err))
+
+    threads = [threading.Thread(target=upload) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 1
+    assert errors == ["Duplicate upload detected: a.wav"]
+    assert len(service.list_uploads("alice")["uploads"]) == 1
+    assert len(list((tmp_path / "uploads" / "alice").iterdir())) == 1
+
+
 def test_upload_requires_keyfinder(tmp_path, monkeypatch):
     monkeypatch.setattr(audio, "_find_keyfinder_cli", lambda: None)
     service = TuneFindService(tmp_path)
     with pytest.raises(RuntimeError, match="keyfinder-cli is required"):
         service.upload_beat("alice", "a.wav", make_tone(220.0))
+
+
+def test_analyze_audio_reuses_result_for_identical_bytes(monkeypatch):
+    calls = []
+    real = audio._estimate_key_keyfinder_cli
+    monkeypatch.setattr(audio, "_estimate_key_keyfinder_cli", lambda *args: calls.append(1) or real(*args))
+
+    tone = make_tone(220.0)
+    first = audio.analyze_audio(tone)
+    second = audio.analyze_audio(tone)
+
+    assert second is first
+    assert len(calls) == 1
+
+
+def test_multipart_parts_are_spooled_and_hashed(tmp_path):
+    files = [("a.wav", make_tone(220.0)), ("b.wav", b"\r\n--not-a-boundary\r\n")]
+    body = b"".join(
+        b"--xyz\r\nContent-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\n\r\n%s\r\n"
+        % (name.encode(), data)
+        for name, data in files
+    ) + b"--xyz--\r\n"
+    parser = StreamingFormDataParser(headers={"Content-Type": "multipart/form-data; boundary=xyz"})
+    target = FilePartsTarget(str(tmp_path))
+    parser.register("file", target)
+    for i in range(0, len(body), 1000):
+        parser.data_received(body[i : i + 1000])
+
+    assert [(name, path.read_bytes(), digest) for name, path, digest in target.parts] == [
+        (name, data, hashlib.sha256(data).hexdigest()) for name, data in files
+    ]
+
+
+def test_static_assets_revalidate_with_etag(http_server):
+    first = get(http_server, "/")
+    assert first.status == 200
+    assert first.read() == b"<html></html>"
+    etag = first.getheader("ETag")
+    assert etag == get(http_server, "/index.html").getheader("ETag")
+
+    cached = get(http_server, "/", {"If-None-Match": etag})
+    assert cached.status == 304
+    assert cached.read() == b""
+    assert get(http_server, "/", {"If-None-Match": '"stale"'}).status == 200
+    assert get(http_server, "/static/../index.html").status == 404
+
+
+def test_large_json_is_streamed_without_content_length(http_server, monkeypatch):
+    uploads = [{"beat_id": f"b{i}", "filename": f"beat-{i}.wav"} for i in range(5000)]
+    monkeypatch.setattr(http_server.service, "list_uploads", lambda owner_id: {"uploads": uploads})
+
+    response = get(http_server, "/uploads?owner_id=alice")
+    assert response.status == 200
+    assert response.getheader("Content-Length") is None
+    assert json.loads(response.read()) == {"uploads": uploads}
+
+    small = get(http_server, "/health")
+    assert int(small.getheader("Content-Length")) == len(small.read())
+
+
+def test_search_memo_is_reused_until_owner_generation_changes(tmp_path, monkeypatch):
+    service = TuneFindService(tmp_path)
+    low = service.upload_beat("alice", "low.wav", make_tone(220.0))
+    service.upload_beat("alice", "high.wav", make_tone(660.0))
+    calls = []
+    real = service_module.extract_features
+    monkeypatch.setattr(service_module, "extract_features", lambda source: calls.append(1) or real(source))
+    hum = make_tone(230.0)
+
+    first = service.search_by_hum("alice", hum)
+    service.upload_beat("bob", "other.wav", make_tone(440.0))
+    assert service.search_by_hum("alice", hum) == first
+    assert len(calls) == 1
+
+    service.delete_upload("alice", low["beat_id"])
+    result = service.search_by_hum("alice", hum)
+    assert len(calls) == 2
+    assert [m["filename"] for m in result["matches"]] == ["high.wav"]
+
+
+@pytest.mark.parametrize("backend", ["numba", "dsp"])
+def test_optional_kernels_match_numpy(backend, monkeypatch):
+    if backend == "numba":
+        pytest.importorskip("numba")
+        assert audio.numba is not None
+        # _autocorr_sweep and _pitch_lags prefer the Cython kernels.
+        monkeypatch.setattr(audio, "_dsp", None)
+    elif audio._dsp is None:
+        pytest.skip("Cython extension not built")
+    rng = np.random.default_rng(0)
+    frames = [
+        rng.standard_normal((50, audio.FRAME_SIZE)).astype(np.float32),
+        np.zeros((4, audio.FRAME_SIZE), dtype=np.float32),
+    ]
+    onsets = [rng.random(500).astype(np.float32), np.zeros(500, dtype=np.float32)]
+
+    def run_kernels():
+        return (
+            [audio._frame_features(f) for f in frames],
+            [audio._autocorr_sweep(x, 10, 50) for x in onsets],
+            [audio._pitch_lags(f, 8, 160) for f in frames],
+        )
+
+    fast_features, fast_sweeps, fast_lags = run_kernels()
+    monkeypatch.setattr(audio, "numba", None)
+    monkeypatch.setattr(audio, "_dsp", None)
+    features, sweeps, lags = run_kernels()
+
+    for fast, expected in zip(fast_features + fast_sweeps, features + sweeps):
+        np.testing.assert_allclose(fast, expected, rtol=1e-4, atol=1e-4)
+    for fast, expected in zip(fast_lags, lags):
+        np.testing.assert_array_equal(fast, expected)
@@ -24,16 +24,17 @@ def main() -> None:
 
     sub.add_parser("setup-keyfinder", help="Install ffmpeg + keyfinder-cli system dependencies")
     sub.add_parser("setup-deps", help="Install all default dependencies (pip + system)")
+    sub.add_parser("build-dsp", help="Compile the optional Cython autocorrelation kernels")
 
     args = parser.parse_args()
     service = TuneFindService(Path(args.data_dir))
 
     if args.cmd == "upload":
         path = Path(args.file)
-        result = service.upload_beat(args.owner_id, path.name, path.read_bytes())
+        result = service.upload_beat(args.owner_id, path.name, path)
         print(result)
     elif args.cmd == "search":
-        result = service.search_by_hum(args.owner_id, Path(args.file).read_bytes(), top_k=args.top_k)
+        result = service.search_by_hum(args.owner_id, Path(args.file), top_k=args.top_k)
         print(result)
     elif args.cmd == "setup-keyfinder":
         script = Path(__file__).resolve().parent / "scripts" / "setup_default_deps.py"
@@ -49,6 +50,13 @@ def main() -> None:
             sys.exit(1)
         result = subprocess.run([sys.executable, str(script)])
         sys.exit(result.returncode)
+    elif args.cmd == "build-dsp":
+        script = Path(__file__).resolve().parent / "scripts" / "build_dsp_extension.py"
+        if not script.exists():
+            print("build_dsp_extension.py not found.")
+            sys.exit(1)
+        result = subprocess.run([sys.executable, str(script)])
+        sys.exit(result.returncode)
 
 
 if __name__ == "__main__":